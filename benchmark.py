@@ -0,0 +1,218 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from benchmark_servers import ArxivFixtures, FakeLLMState, StubServer, install_benchmark_tokenizer
+from utils import get_peak_rss_mb, reset_peak_rss
+
+# The real tokenizer would load the full gguf model, set BENCHMARK_REAL_TOKENIZER=1 to load only its vocabulary instead
+install_benchmark_tokenizer(os.environ.get("BENCHMARK_REAL_TOKENIZER") == "1")
+
+import lm_studio_caller
+import fetch_data
+import clean_data
+from fetch_data import fetch_arxiv_papers
+from clean_data import get_filtered_sections_papers, get_and_extract_paper_segmented_content, clean_latex
+from prompts import build_condensed_prompt
+from condense_data import condensed_papers
+from qa_pairs_generation import generate_all_qa_pairs
+
+BENCHMARKS_FOLDER = ".benchmarks"
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def measure_stage(name, func, count_items, repeat, trace_memory, input_chars=None, setup=None):
+    print(f"=> {name}")
+
+    # setup builds a fresh input for every run outside of the timed region, for stages that mutate their input
+    get_inputs = lambda: (setup(),) if setup is not None else ()
+
+    times = []
+    reset_peak_rss()
+    for _ in range(repeat):
+        inputs = get_inputs()
+        start = time.perf_counter()
+        result = func(*inputs)
+        times.append(time.perf_counter() - start)
+    rss_peak_mb = get_peak_rss_mb()
+
+    python_peak_mb = None
+    if trace_memory:
+        # Separate pass, tracemalloc slows allocations down too much to time with it on
+        inputs = get_inputs()
+        tracemalloc.start()
+        func(*inputs)
+        python_peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    median = statistics.median(times)
+    items = count_items(result)
+    stage = {
+        "seconds_median": median,
+        "seconds_min": min(times),
+        "seconds_all": times,
+        "items": items,
+        "items_per_second": items / median if median > 0 else None,
+        "python_peak_mb": python_peak_mb,
+        "rss_peak_mb": rss_peak_mb
+    }
+    if input_chars is not None:
+        stage["mb_per_second"] = input_chars / (1024 * 1024) / median if median > 0 else None
+
+    print(f"   {median:.3f}s median, {items} items, {stage['items_per_second'] or 0:.2f} items/s")
+
+    return result, stage
+
+def extract_raw_sections(papers):
+    raw_sections = []
+    for i, paper in enumerate(papers):
+        folder = f"raw_{i}"
+        sections = get_and_extract_paper_segmented_content(paper, folder)
+        shutil.rmtree(folder, ignore_errors=True)
+        if sections:
+            raw_sections.extend(sections.values())
+
+    return raw_sections
+
+def run_benchmark(papers_amount=20, paper_words=800, llm_latency=0.05, llm_token_latency=0.0, llm_parallel_slots=1, repeat=3, trace_memory=True, fixtures_dir=None):
+    fixtures = ArxivFixtures(papers_amount, paper_words, fixtures_dir=fixtures_dir)
+    llm_state = FakeLLMState(llm_latency, llm_token_latency, llm_parallel_slots)
+    stages = {}
+
+    with StubServer(fixtures, llm_state) as server, tempfile.TemporaryDirectory() as work_dir:
+        previous_urls = (fetch_data.ARXIV_API_URL, clean_data.ARXIV_EPRINT_URL, lm_studio_caller.LM_STUDIO_API)
+        fetch_data.ARXIV_API_URL = f"{server.base_url}/api/query"
+        clean_data.ARXIV_EPRINT_URL = f"{server.base_url}/e-print"
+        lm_studio_caller.LM_STUDIO_API = f"{server.base_url}/v1/chat/completions"
+
+        current_dir = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            papers, stages["fetch_arxiv_papers"] = measure_stage(
+                "fetch_arxiv_papers",
+                lambda: fetch_arxiv_papers(None, query="benchmark", max_results=papers_amount),
+                len, repeat, trace_memory
+            )
+
+            cleaned_papers, stages["get_filtered_sections_papers"] = measure_stage(
+                "get_filtered_sections_papers",
+                get_filtered_sections_papers,
+                len, repeat, trace_memory,
+                setup=lambda: copy.deepcopy(papers)
+            )
+
+            raw_sections = extract_raw_sections(papers)
+            _, stages["clean_latex"] = measure_stage(
+                "clean_latex",
+                lambda: [clean_latex(section) for section in raw_sections],
+                len, repeat, trace_memory, sum(len(section) for section in raw_sections)
+            )
+
+            _, stages["build_condensed_prompt"] = measure_stage(
+                "build_condensed_prompt",
+                lambda: [build_condensed_prompt(paper) for paper in cleaned_papers],
+                len, repeat, trace_memory
+            )
+
+            condensed, stages["condensed_papers"] = measure_stage(
+                "condensed_papers",
+                condensed_papers,
+                len, repeat, trace_memory,
+                setup=lambda: copy.deepcopy(cleaned_papers)
+            )
+
+            _, stages["generate_all_qa_pairs"] = measure_stage(
+                "generate_all_qa_pairs",
+                lambda: generate_all_qa_pairs(condensed),
+                len, repeat, trace_memory
+            )
+        finally:
+            os.chdir(current_dir)
+            fetch_data.ARXIV_API_URL, clean_data.ARXIV_EPRINT_URL, lm_studio_caller.LM_STUDIO_API = previous_urls
+
+    return {
+        "commit": get_git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "papers_amount": papers_amount,
+            "paper_words": paper_words,
+            "llm_latency": llm_latency,
+            "llm_token_latency": llm_token_latency,
+            "llm_parallel_slots": llm_parallel_slots,
+            "repeat": repeat,
+            "fixtures_dir": fixtures_dir
+        },
+        "llm_server": {"requests": llm_state.requests, "max_in_flight": llm_state.max_in_flight},
+        "stages": stages
+    }
+
+def save_results(results, folder=BENCHMARKS_FOLDER):
+    os.makedirs(folder, exist_ok=True)
+    file_name = f"{folder}/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['commit']}.json"
+    with open(file_name, "w") as f:
+        json.dump(results, f, indent=2)
+
+    return file_name
+
+def compare_results(baseline, results):
+    comparable_keys = [key for key in results["config"] if key != "repeat"]
+    if any(baseline["config"].get(key) != results["config"][key] for key in comparable_keys):
+        print("⚠️ Benchmark configurations differ, the comparison is only indicative")
+
+    print(f"{'stage':<32}{baseline['commit']:>12}{results['commit']:>12}{'speedup':>10}")
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["seconds_median"]
+        after = stage["seconds_median"]
+        speedup = before / after if after > 0 else float("inf")
+        print(f"{name:<32}{before:>11.3f}s{after:>11.3f}s{speedup:>9.2f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time every dataset creation stage against local arXiv and LLM stand-ins")
+    parser.add_argument("--papers", type=int, default=20)
+    parser.add_argument("--paper-words", type=int, default=800)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds per completion request")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="Extra seconds per generated word")
+    parser.add_argument("--llm-parallel-slots", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass")
+    parser.add_argument("--fixtures-dir", default=None, help="Recorded feed.xml, eprint/ and pdf/ instead of synthetic papers")
+    parser.add_argument("--compare", default=None, help="Previous benchmark JSON to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.papers,
+        args.paper_words,
+        args.llm_latency,
+        args.llm_token_latency,
+        args.llm_parallel_slots,
+        args.repeat,
+        not args.no_memory,
+        args.fixtures_dir
+    )
+    print(f"Results saved to {save_results(results)}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare_results(json.load(f), results)
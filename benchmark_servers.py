@@ -0,0 +1,261 @@
+import io
+import json
+import os
+import random
+import re
+import sys
+import tarfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from PyPDF2 import PdfWriter
+
+WORDS = (
+    "model gradient attention layer transformer loss training dataset token embedding optimizer "
+    "convolution network parameter inference benchmark accuracy latency memory sparse dense "
+    "regularization distribution sampling encoder decoder residual normalization batch"
+).split()
+
+SECTION_TITLES = ["Introduction", "Related Work", "Method", "Experiments", "Results", "Conclusion"]
+
+def random_sentence(rng, words_amount):
+    return " ".join(rng.choice(WORDS) for _ in range(words_amount)).capitalize() + "."
+
+def random_paragraph(rng, words_amount):
+    sentences = []
+    while words_amount > 0:
+        sentence_words = min(words_amount, rng.randint(8, 20))
+        sentences.append(random_sentence(rng, sentence_words))
+        words_amount -= sentence_words
+
+    return " ".join(sentences)
+
+def build_synthetic_latex(rng, paper_words):
+    section_words = max(20, paper_words // (len(SECTION_TITLES) + 1))
+
+    parts = [
+        "\\documentclass{article}\n\\usepackage{amsmath}\n\\title{Synthetic paper}\n\\begin{document}\n\\maketitle\n",
+        f"\\begin{{abstract}}\n{random_paragraph(rng, section_words)}\n\\end{{abstract}}\n"
+    ]
+    for i, title in enumerate(SECTION_TITLES):
+        parts.append(f"\\section{{{title}}}\n{random_paragraph(rng, section_words // 2)} % comment to strip\n")
+        parts.append(f"\\subsection{{{title} details}}\n\\textbf{{{rng.choice(WORDS)}}} \\cite{{ref{i}}} $x_{i} = \\alpha y^{i}$.\n")
+        parts.append(f"\\begin{{equation}}\nL_{i} = \\sum_j \\log p(y_j | x_j)\n\\end{{equation}}\n")
+        parts.append(f"\\begin{{itemize}}\n\\item {random_sentence(rng, 6)}\n\\item {random_sentence(rng, 6)}\n\\end{{itemize}}\n")
+        parts.append(f"{random_paragraph(rng, section_words // 2)}\n")
+    parts.append("\\end{document}\n")
+
+    return "".join(parts)
+
+def normalize_arxiv_id(arxiv_id):
+    # Feed links carry a version suffix (2401.00001v2), fixtures are stored and looked up without it
+    return re.sub(r"v\d+$", "", arxiv_id)
+
+def build_eprint_tarball(latex):
+    tar_bytes = io.BytesIO()
+    with tarfile.open(fileobj=tar_bytes, mode="w:gz") as tar:
+        content = latex.encode("utf-8")
+        info = tarfile.TarInfo("main.tex")
+        info.size = len(content)
+        info.mtime = 0
+        tar.addfile(info, io.BytesIO(content))
+
+    return tar_bytes.getvalue()
+
+def build_outlined_pdf(titles):
+    writer = PdfWriter()
+    for _ in titles:
+        writer.add_blank_page(width=612, height=792)
+    for i, title in enumerate(titles):
+        writer.add_outline_item(f"{i + 1} {title}", i)
+
+    pdf_bytes = io.BytesIO()
+    writer.write(pdf_bytes)
+
+    return pdf_bytes.getvalue()
+
+def build_atom_feed(entries, base_url):
+    xml_entries = []
+    for entry in entries:
+        xml_entries.append(
+            "<entry>"
+            f"<id>http://arxiv.org/abs/{entry['arxiv_id']}v{entry['version']}</id>"
+            f"<title>{escape(entry['title'])}</title>"
+            f"<summary>{escape(entry['summary'])}</summary>"
+            f"<link title=\"pdf\" href=\"{base_url}/pdf/{entry['arxiv_id']}\" rel=\"related\" type=\"application/pdf\"/>"
+            "</entry>"
+        )
+
+    return (
+        "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+        "<feed xmlns=\"http://www.w3.org/2005/Atom\">"
+        + "".join(xml_entries)
+        + "</feed>"
+    ).encode("utf-8")
+
+class ArxivFixtures():
+    def __init__(self, papers_amount=20, paper_words=800, seed=0, fixtures_dir=None):
+        self.entries: list = []
+        self.eprints: dict = {}
+        self.pdfs: dict = {}
+        self.recorded_feed: bytes = None
+
+        if fixtures_dir is not None:
+            self.load_recorded(fixtures_dir)
+        else:
+            self.generate(papers_amount, paper_words, seed)
+
+    def generate(self, papers_amount, paper_words, seed):
+        rng = random.Random(seed)
+        for i in range(papers_amount):
+            arxiv_id = f"2401.{i:05d}"
+            self.entries.append({
+                "arxiv_id": arxiv_id,
+                "version": 1,
+                "title": f"Synthetic paper {i}: {random_sentence(rng, 5)[:-1]}",
+                "summary": random_paragraph(rng, 60)
+            })
+            self.eprints[arxiv_id] = build_eprint_tarball(build_synthetic_latex(rng, paper_words))
+            self.pdfs[arxiv_id] = build_outlined_pdf(SECTION_TITLES)
+
+    def load_recorded(self, fixtures_dir):
+        # Layout: feed.xml, eprint/<arxiv id> (tar.gz) and pdf/<arxiv id>, ids with "/" stored with "_",
+        # a version suffix in the file names is accepted and ignored
+        with open(f"{fixtures_dir}/feed.xml", "rb") as f:
+            self.recorded_feed = f.read()
+
+        for kind, store in (("eprint", self.eprints), ("pdf", self.pdfs)):
+            folder = f"{fixtures_dir}/{kind}"
+            for file in os.listdir(folder) if os.path.isdir(folder) else []:
+                with open(f"{folder}/{file}", "rb") as f:
+                    store[normalize_arxiv_id(file.replace("_", "/"))] = f.read()
+
+    def get_feed(self, base_url, max_results):
+        if self.recorded_feed is not None:
+            feed = self.recorded_feed
+            for arxiv_pdf_url in (b"http://arxiv.org/pdf/", b"https://arxiv.org/pdf/"):
+                feed = feed.replace(arxiv_pdf_url, f"{base_url}/pdf/".encode("utf-8"))
+            return feed
+
+        return build_atom_feed(self.entries[:max_results], base_url)
+
+class StubLlama():
+    # Roughly one token per word or punctuation mark, close enough to keep the prompt budgeting realistic
+    def __init__(self, model_path=None, **kwargs):
+        self.model_path: str = model_path
+
+    def tokenize(self, text, add_bos=True):
+        tokens = re.findall(r"\w+|[^\w\s]", text.decode("utf-8", errors="ignore"))
+        return ([0] if add_bos else []) + [hash(token) for token in tokens]
+
+def install_benchmark_tokenizer(real_tokenizer=False):
+    # Must run before lm_studio_caller is imported, it builds its tokenizer at import time
+    if real_tokenizer:
+        import llama_cpp
+        real_llama = llama_cpp.Llama
+        llama_cpp.Llama = lambda *args, **kwargs: real_llama(*args, **{**kwargs, "vocab_only": True})
+        return
+
+    stub_module = types.ModuleType("llama_cpp")
+    stub_module.Llama = StubLlama
+    sys.modules["llama_cpp"] = stub_module
+
+class FakeLLMState():
+    def __init__(self, latency=0.05, token_latency=0.0, parallel_slots=1):
+        self.latency: float = latency
+        self.token_latency: float = token_latency
+        self.slots = threading.Semaphore(parallel_slots)
+        self.lock = threading.Lock()
+        self.requests: int = 0
+        self.max_in_flight: int = 0
+        self.in_flight: int = 0
+
+def build_fake_completion(sys_prompt, usr_prompt):
+    if "question-and-answer" in sys_prompt:
+        qas = [
+            {"question": f"What does the paper state about {word}?", "answer": f"The paper describes {word} in detail."}
+            for word in WORDS[:3]
+        ]
+        return f"```json\n{json.dumps(qas)}\n```"
+
+    if "evaluate the quality" in sys_prompt:
+        return "```json\n{\"accuracy\": 7, \"relevance\": 8, \"clarity\": 8, \"completeness\": 6, \"comments\": \"stub\"}\n```"
+
+    # Condensing: keep roughly a quarter of the words like a real compression would
+    words = usr_prompt.split()
+    return " ".join(words[len(words) - len(words) // 4:])
+
+def make_handler(fixtures, llm_state, base_url_holder):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_bytes(self, status, content, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/api/query":
+                max_results = int(parse_qs(url.query).get("max_results", ["100"])[0])
+                return self.send_bytes(200, fixtures.get_feed(base_url_holder[0], max_results), "application/atom+xml")
+
+            for prefix, store, content_type in (("/e-print/", fixtures.eprints, "application/gzip"), ("/pdf/", fixtures.pdfs, "application/pdf")):
+                if url.path.startswith(prefix):
+                    content = store.get(normalize_arxiv_id(url.path[len(prefix):]))
+                    if content is None:
+                        return self.send_bytes(404, b"not found", "text/plain")
+                    return self.send_bytes(200, content, content_type)
+
+            self.send_bytes(404, b"not found", "text/plain")
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/v1/chat/completions":
+                return self.send_bytes(404, b"not found", "text/plain")
+
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            messages = {m["role"]: m["content"] for m in payload.get("messages", [])}
+            content = build_fake_completion(messages.get("system", ""), messages.get("user", ""))
+
+            # Requests beyond the parallel slots queue up, like a local inference server
+            with llm_state.slots:
+                with llm_state.lock:
+                    llm_state.requests += 1
+                    llm_state.in_flight += 1
+                    llm_state.max_in_flight = max(llm_state.max_in_flight, llm_state.in_flight)
+                time.sleep(llm_state.latency + llm_state.token_latency * len(content.split()))
+                with llm_state.lock:
+                    llm_state.in_flight -= 1
+
+            response = {
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+            }
+            self.send_bytes(200, json.dumps(response).encode("utf-8"), "application/json")
+
+    return StubHandler
+
+class StubServer():
+    def __init__(self, fixtures, llm_state, host="127.0.0.1", port=0):
+        base_url_holder = [None]
+        self.llm_state: FakeLLMState = llm_state
+        self.server = ThreadingHTTPServer((host, port), make_handler(fixtures, llm_state, base_url_holder))
+        self.base_url: str = f"http://{host}:{self.server.server_address[1]}"
+        base_url_holder[0] = self.base_url
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
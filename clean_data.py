@@ -9,6 +9,8 @@ import shutil
 from tqdm import tqdm
 from fetch_data import download_pdf
 
+ARXIV_EPRINT_URL = "https://arxiv.org/e-print"
+
 def tokenize_latex(latex, pattern):
     tokens = []
     pos = 0
@@ -107,7 +109,7 @@ def extract_flat_sections(latex, pattern, command_levels, env_levels):
 
 def get_and_extract_paper_segmented_content(paper, folder):
     arxiv_id = paper["pdf_url"].split("/")[-1]
-    url = f"https://arxiv.org/e-print/{arxiv_id}"
+    url = f"{ARXIV_EPRINT_URL}/{arxiv_id}"
 
     response = requests.get(url)
     if response.status_code != 200:
@@ -0,0 +1,114 @@
+from sentence_transformers import SentenceTransformer
+import numpy as np
+import hashlib
+import os
+
+SBERT_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDINGS_CACHE_FOLDER = ".cache/embeddings"
+
+_sbert_models = {}
+
+def get_sbert_model(model_name):
+    if model_name not in _sbert_models:
+        _sbert_models[model_name] = SentenceTransformer(model_name)
+
+    return _sbert_models[model_name]
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache():
+    def __init__(self, model_name, folder=EMBEDDINGS_CACHE_FOLDER):
+        self.model_name: str = model_name
+        self.file_name: str = f"{folder}/{model_name.replace('/', '_')}.npz"
+        self.embeddings: dict = {}
+
+        if os.path.exists(self.file_name):
+            with np.load(self.file_name) as data:
+                self.embeddings = dict(zip(data["hashes"].tolist(), data["embeddings"]))
+
+    def encode(self, texts, batch_size=64):
+        hashes = [text_hash(text) for text in texts]
+
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in self.embeddings:
+                missing[h] = text
+
+        if missing:
+            # Normalized once here so every cosine similarity becomes a plain dot product
+            new_embeddings = get_sbert_model(self.model_name).encode(
+                list(missing.values()),
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=len(missing) > batch_size
+            )
+            self.embeddings.update(zip(missing.keys(), new_embeddings.astype(np.float32)))
+            self.save()
+
+        return np.stack([self.embeddings[h] for h in hashes])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        hashes = list(self.embeddings.keys())
+        np.savez(self.file_name, hashes=np.array(hashes), embeddings=np.stack([self.embeddings[h] for h in hashes]))
+
+def pad_outputs(qa_pairs, key, text_rows):
+    max_outputs = max((len(qa.get(key, [])) for qa in qa_pairs), default=0)
+    rows = np.zeros((len(qa_pairs), max(1, max_outputs)), dtype=np.int64)
+    mask = np.zeros(rows.shape, dtype=bool)
+
+    for i, qa in enumerate(qa_pairs):
+        for j, output in enumerate(qa.get(key, [])):
+            rows[i, j] = text_rows[output]
+            mask[i, j] = True
+
+    return rows, mask
+
+def masked_mean(values, mask):
+    counts = mask.reshape(len(mask), -1).sum(axis=1)
+    sums = np.where(mask, values, 0.0).reshape(len(mask), -1).sum(axis=1)
+
+    return [float(s / c) if c else None for s, c in zip(sums, counts)]
+
+def compute_sbert_similarities(qa_pairs, model_name=SBERT_MODEL_NAME, batch_size=64):
+    if not qa_pairs:
+        return []
+
+    texts = list(dict.fromkeys(
+        [qa["answer"] for qa in qa_pairs]
+        + [output for qa in qa_pairs for output in qa.get("llm_output", [])]
+        + [output for qa in qa_pairs for output in qa.get("llm_finetuned_output", [])]
+    ))
+    text_rows = {text: i for i, text in enumerate(texts)}
+    embeddings = EmbeddingCache(model_name).encode(texts, batch_size)
+
+    answers = embeddings[[text_rows[qa["answer"]] for qa in qa_pairs]]
+    base_rows, base_mask = pad_outputs(qa_pairs, "llm_output", text_rows)
+    finetuned_rows, finetuned_mask = pad_outputs(qa_pairs, "llm_finetuned_output", text_rows)
+    base = embeddings[base_rows]
+    finetuned = embeddings[finetuned_rows]
+
+    # (n, d) x (n, r, d) -> (n, r) and (n, r, d) x (n, s, d) -> (n, r, s) in batched matmuls
+    finetuned_scores = np.einsum("nd,nrd->nr", answers, finetuned)
+    base_scores = np.einsum("nd,nrd->nr", answers, base)
+    diff_scores = np.matmul(base, finetuned.transpose(0, 2, 1))
+    diff_mask = base_mask[:, :, None] & finetuned_mask[:, None, :]
+
+    similarities_scores = [
+        {
+            "question": qa["question"],
+            "avg_score": avg_score,
+            "avg_base_score": avg_base_score,
+            "avg_diff_score": avg_diff_score
+        }
+        for qa, avg_score, avg_base_score, avg_diff_score in zip(
+            qa_pairs,
+            masked_mean(finetuned_scores, finetuned_mask),
+            masked_mean(base_scores, base_mask),
+            masked_mean(diff_scores, diff_mask)
+        )
+    ]
+
+    return sorted(similarities_scores, key=lambda s: float("inf") if s["avg_score"] is None else s["avg_score"])
@@ -1,8 +1,18 @@
+import re
 import requests
 from xml.etree import ElementTree
 
+ARXIV_API_URL = "http://export.arxiv.org/api/query"
+
+def parse_arxiv_id(entry_id):
+    match = re.search(r"abs/(.+?)(?:v(\d+))?$", entry_id)
+    if match is None:
+        return entry_id, 1
+
+    return match.group(1), int(match.group(2) or 1)
+
 def fetch_arxiv_papers(_, query="deep learning", max_results=100):
-    url = f"http://export.arxiv.org/api/query?search_query=all:{query}&start=0&max_results={max_results}"
+    url = f"{ARXIV_API_URL}?search_query=all:{query}&start=0&max_results={max_results}"
     response = requests.get(url)
     root = ElementTree.fromstring(response.content)
     
@@ -12,7 +22,8 @@ def fetch_arxiv_papers(_, query="deep learning", max_results=100):
         summary = entry.find("{http://www.w3.org/2005/Atom}summary").text.strip()
         pdf_link = entry.find("{http://www.w3.org/2005/Atom}link[@title='pdf']")
         pdf_url = pdf_link.attrib["href"] if pdf_link is not None else ""
-        papers.append({"title": title, "summary": summary, "pdf_url": pdf_url})
+        arxiv_id, version = parse_arxiv_id(entry.find("{http://www.w3.org/2005/Atom}id").text.strip())
+        papers.append({"title": title, "summary": summary, "pdf_url": pdf_url, "arxiv_id": arxiv_id, "version": version})
 
     return papers
 
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from prompts import build_evaluation_prompt
+from lm_studio_caller import call_llm, LM_STUDIO_MODEL
+
+CRITERIA = ["accuracy", "relevance", "clarity", "completeness"]
+VERDICTS_CACHE_FILE = ".cache/judge_verdicts.json"
+SCORE_PATTERN = r"(\d+(?:\.\d+)?)(?:\s*/\s*(\d+(?:\.\d+)?))?"
+
+class VerdictCache():
+    def __init__(self, file_name=VERDICTS_CACHE_FILE):
+        self.file_name: str = file_name
+        self.lock = threading.Lock()
+        self.verdicts: dict = {}
+
+        if os.path.exists(file_name):
+            with open(file_name, "r") as f:
+                self.verdicts = json.load(f)
+
+    def get(self, key):
+        with self.lock:
+            return self.verdicts.get(key)
+
+    def set(self, key, verdict):
+        with self.lock:
+            self.verdicts[key] = verdict
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+            with open(self.file_name, "w") as f:
+                json.dump(self.verdicts, f)
+
+def get_verdict_key(sys_prompt, usr_prompt, temperature):
+    return hashlib.sha256(f"{LM_STUDIO_MODEL}|{temperature}|{sys_prompt}|{usr_prompt}".encode("utf-8")).hexdigest()
+
+def parse_score(value):
+    # json.loads turns true into a bool and NaN into a float, neither is a score
+    if isinstance(value, bool):
+        return None
+
+    if isinstance(value, str):
+        # Judges often answer "8/10" or a quoted "8" instead of a bare number
+        match = re.fullmatch(SCORE_PATTERN, value.strip().strip("\"'"))
+        if match is None:
+            return None
+
+        value = float(match.group(1))
+        if match.group(2) is not None and float(match.group(2)) > 0:
+            value = value * 10.0 / float(match.group(2))
+
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if not math.isfinite(score):
+        return None
+
+    return min(10.0, max(0.0, score))
+
+def extract_evaluation_scores(output: str):
+    match = re.search(r"\{.*\}", output, re.DOTALL)
+    if match is not None:
+        json_content = match.group(0)
+        for candidate in (json_content, json_content.replace("'", '"')):
+            try:
+                data = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+
+            if isinstance(data, dict):
+                data = {key.lower(): value for key, value in data.items()}
+                scores = {criterion: parse_score(data.get(criterion)) for criterion in CRITERIA}
+                if all(score is not None for score in scores.values()):
+                    scores["comments"] = str(data.get("comments", ""))
+                    return scores
+
+    # The judge sometimes answers with almost-JSON or a plain list, so each criterion is looked up on its own
+    scores = {}
+    for criterion in CRITERIA:
+        criterion_match = re.search(rf"{criterion}(?:\s*\(0-10\))?\W{{0,5}}?[:=]\s*\**\s*[\"']?\s*({SCORE_PATTERN})", output, re.IGNORECASE)
+        if criterion_match is None:
+            return None
+        scores[criterion] = parse_score(criterion_match.group(1))
+
+    scores["comments"] = ""
+    return scores
+
+def judge_answer(question, answer, llm_output, cache, max_retry=3, temperature=0.0):
+    sys_prompt, usr_prompt = build_evaluation_prompt(question, answer, llm_output)
+    key = get_verdict_key(sys_prompt, usr_prompt, temperature)
+
+    verdict = cache.get(key)
+    if verdict is not None:
+        return verdict
+
+    for _ in range(max_retry):
+        output = call_llm(sys_prompt, usr_prompt, temperature)
+        if "[ERROR]" in output:
+            continue
+
+        verdict = extract_evaluation_scores(output)
+        if verdict is not None:
+            cache.set(key, verdict)
+            return verdict
+
+    return None
+
+def compute_judge_statistics(verdicts):
+    valid_verdicts = [v for v in verdicts if v is not None]
+    statistics = {"count": len(verdicts), "failures": len(verdicts) - len(valid_verdicts)}
+    if not valid_verdicts:
+        return statistics
+
+    scores = np.array([[v[criterion] for criterion in CRITERIA] for v in valid_verdicts], dtype=np.float64)
+    means = scores.mean(axis=0)
+    stds = scores.std(axis=0)
+    medians = np.median(scores, axis=0)
+    p10, p90 = np.percentile(scores, [10, 90], axis=0)
+
+    for i, criterion in enumerate(CRITERIA):
+        statistics[criterion] = {
+            "mean": float(means[i]),
+            "std": float(stds[i]),
+            "median": float(medians[i]),
+            "p10": float(p10[i]),
+            "p90": float(p90[i])
+        }
+    statistics["overall_mean"] = float(scores.mean())
+
+    return statistics
+
+def judge_all_answers(qa_pairs, output_keys=("llm_output", "llm_finetuned_output"), max_workers=4, max_retry=3, temperature=0.0, save_every=50):
+    cache = VerdictCache()
+
+    jobs = []
+    for qa in qa_pairs:
+        for output_key in output_keys:
+            qa[f"{output_key}_judgements"] = [None] * len(qa.get(output_key, []))
+            for j, llm_output in enumerate(qa.get(output_key, [])):
+                jobs.append((qa, output_key, j, llm_output))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(judge_answer, qa["question"], qa["answer"], llm_output, cache, max_retry, temperature): (qa, output_key, j)
+            for qa, output_key, j, llm_output in jobs
+        }
+
+        for done, future in enumerate(tqdm(as_completed(futures), total=len(futures)), start=1):
+            qa, output_key, j = futures[future]
+            qa[f"{output_key}_judgements"][j] = future.result()
+
+            if done % save_every == 0:
+                cache.save()
+
+    cache.save()
+
+    statistics = {
+        output_key: compute_judge_statistics([v for qa in qa_pairs for v in qa[f"{output_key}_judgements"]])
+        for output_key in output_keys
+    }
+
+    return {"qa_pairs": qa_pairs, "statistics": statistics}
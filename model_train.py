@@ -1,153 +1,437 @@
-from datasets import Dataset
+from datasets import Dataset, load_from_disk
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     BitsAndBytesConfig,
     Trainer,
-    TrainingArguments
+    TrainingArguments,
+    TrainerCallback
 )
+from transformers.trainer_utils import get_last_checkpoint
 from peft import LoraConfig, get_peft_model
-from transformers import DataCollatorForLanguageModeling
+from transformers import DataCollatorForSeq2Seq, DataCollatorWithFlattening
+import hashlib
+import importlib.util
+import json
 import os
+import random
+import shutil
+import time
+import torch
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional
+from utils import cpu_supports_bf16, get_peak_rss_mb, reset_peak_rss, build_chat_prompt, DEFAULT_SYS_PROMPT
 
-def cpu_train(qas_pairs, train_model_name, sequences_lenght, finetuned_model_name):
+IGNORE_INDEX = -100
+TOKENIZED_CACHE_FOLDER = ".cache/tokenized"
+# Bump whenever tokenize_qa_pairs changes its output (template, masking, truncation, EOS)
+TOKENIZATION_FORMAT_VERSION = 3
+# Settings that only change speed, logging or where files go, a requeued job resumes whatever their value
+RUN_KEY_IGNORED_FIELDS = (
+    "num_threads", "num_interop_threads", "pin_threads", "tokenization_num_proc", "use_tokenized_cache",
+    "eval_steps", "save_steps", "logging_steps", "save_total_limit", "output_folder"
+)
+
+def build_data_list(qas_pairs, sys_prompt=DEFAULT_SYS_PROMPT):
+    # The question alone, in the same chat format the fine-tuned model is questioned with
     data_list = []
-    for article, qa_pairs in qas_pairs.items():
+    for qa_pairs in qas_pairs.values():
         for pair in qa_pairs:
-            instruction = f"[{article}] {pair['question']}"
-            output = pair["answer"]
-            data_list.append({"instruction": instruction, "output": output})
+            data_list.append({"sys_prompt": sys_prompt, "instruction": pair["question"], "output": pair["answer"]})
 
-    print(f"Dataset size: {len(data_list)}")
+    return data_list
 
-    dataset = Dataset.from_list(data_list)
-    dataset = dataset.train_test_split(test_size=0.1)
+def truncate_prompt(prompt_ids, budget, min_budget, bos_token_id):
+    # The prompt is cut from the left so the assistant header stays right before the answer,
+    # and it never takes more than min_budget tokens from the answer
+    budget = max(budget, min_budget)
+    if len(prompt_ids) <= budget:
+        return prompt_ids
 
-    tokenizer = AutoTokenizer.from_pretrained(train_model_name)
+    if prompt_ids and prompt_ids[0] == bos_token_id:
+        return prompt_ids[:1] + prompt_ids[len(prompt_ids) - budget + 1:]
 
-    def tokenize_function(sample):
-        prompt = f"Instruction: {sample['instruction']}\nAnswer: {sample['output']}\n"
-        return tokenizer(prompt, truncation=True, max_length=sequences_lenght)
+    return prompt_ids[len(prompt_ids) - budget:]
 
-    tokenized_datasets = dataset.map(tokenize_function, batched=False)
+def tokenize_qa_pairs(batch, tokenizer, sequences_lenght):
+    prompts = [build_chat_prompt(tokenizer, instruction, sys_prompt) for instruction, sys_prompt in zip(batch["instruction"], batch["sys_prompt"])]
+    answers = list(batch["output"])
 
-    model = AutoModelForCausalLM.from_pretrained(
-        train_model_name,
-        device_map="cpu"
-    )
+    # The chat template already contains <|begin_of_text|>
+    prompts_ids = tokenizer(prompts, add_special_tokens=False)["input_ids"]
+    answers_ids = tokenizer(answers, add_special_tokens=False)["input_ids"]
 
-    lora_config = LoraConfig(
-        r=8,
-        lora_alpha=32,
-        target_modules=["q_proj", "v_proj"],
-        lora_dropout=0.1,
-        bias="none",
-        task_type="CAUSAL_LM",
-    )
-    model = get_peft_model(model, lora_config).to("cpu")
+    tokenized = {"input_ids": [], "attention_mask": [], "labels": [], "length": []}
+    for prompt_ids, answer_ids in zip(prompts_ids, answers_ids):
+        answer_ids = answer_ids + [tokenizer.eos_token_id]
+        prompt_ids = truncate_prompt(prompt_ids, sequences_lenght - len(answer_ids), sequences_lenght // 2, tokenizer.bos_token_id)
+        answer_ids = answer_ids[:sequences_lenght - len(prompt_ids)]
+        input_ids = prompt_ids + answer_ids
 
-    training_args = TrainingArguments(
-        output_dir="./results",
-        num_train_epochs=5,
-        per_device_train_batch_size=1,
-        gradient_accumulation_steps=4,
-        evaluation_strategy="steps",
-        eval_steps=100,
-        save_steps=200,
-        logging_steps=50,
-        learning_rate=2e-4,
-        fp16=False,
-        no_cuda=True,
-        save_total_limit=2,
-        report_to="none",
+        tokenized["input_ids"].append(input_ids)
+        tokenized["attention_mask"].append([1] * len(input_ids))
+        tokenized["labels"].append([IGNORE_INDEX] * len(prompt_ids) + answer_ids)
+        tokenized["length"].append(len(input_ids))
+
+    return tokenized
+
+def get_tokenized_cache_key(data_list, tokenizer, sequences_lenght):
+    key = hashlib.sha256()
+    key.update(json.dumps(data_list, sort_keys=True).encode("utf-8"))
+    key.update(f"{TOKENIZATION_FORMAT_VERSION}|{tokenizer.name_or_path}|{type(tokenizer).__name__}|{len(tokenizer)}|{sequences_lenght}".encode("utf-8"))
+
+    return key.hexdigest()[:16]
+
+def get_tokenized_cache_path(data_list, tokenizer, sequences_lenght):
+    return f"{TOKENIZED_CACHE_FOLDER}/{get_tokenized_cache_key(data_list, tokenizer, sequences_lenght)}"
+
+def build_tokenized_datasets(qas_pairs, tokenizer, sequences_lenght, num_proc=None, use_cache=True, sys_prompt=DEFAULT_SYS_PROMPT):
+    data_list = build_data_list(qas_pairs, sys_prompt)
+    print(f"Dataset size: {len(data_list)}")
+
+    cache_path = get_tokenized_cache_path(data_list, tokenizer, sequences_lenght)
+    if use_cache and os.path.exists(cache_path):
+        print(f"Tokenized dataset loaded from {cache_path}")
+        return load_from_disk(cache_path)
+
+    dataset = Dataset.from_list(data_list)
+    dataset = dataset.train_test_split(test_size=0.1, seed=42)
+
+    tokenized_datasets = dataset.map(
+        tokenize_qa_pairs,
+        fn_kwargs={"tokenizer": tokenizer, "sequences_lenght": sequences_lenght},
+        batched=True,
+        batch_size=256,
+        num_proc=num_proc or min(8, os.cpu_count() or 1),
+        remove_columns=["sys_prompt", "instruction", "output"]
     )
 
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+    if use_cache:
+        tokenized_datasets.save_to_disk(cache_path)
 
-    trainer = Trainer(
-        model=model,
-        args=training_args,
-        train_dataset=tokenized_datasets["train"],
-        eval_dataset=tokenized_datasets["test"],
+    return tokenized_datasets
+
+def build_data_collator(tokenizer, packing=False):
+    if packing:
+        # One flattened row per batch, position_ids restart at every QA pair so
+        # flash_attention_2 never attends across sample boundaries
+        return DataCollatorWithFlattening(return_position_ids=True)
+
+    return DataCollatorForSeq2Seq(
         tokenizer=tokenizer,
-        data_collator=data_collator
+        padding="longest",
+        pad_to_multiple_of=8,
+        label_pad_token_id=IGNORE_INDEX
     )
 
-    trainer.train()
+def load_training_tokenizer(train_model_name):
+    tokenizer = AutoTokenizer.from_pretrained(train_model_name, use_fast=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
-    os.makedirs("finetuned_models", exist_ok=True)
-    model.save_pretrained(f"finetuned_models/{finetuned_model_name}")
+    return tokenizer
 
-def gpu_train(qas_pairs, train_model_name, sequences_lenght, finetuned_model_name):   
-    data_list = []
-    for article, qa_pairs in qas_pairs.items():
-        for pair in qa_pairs:
-            instruction = f"[{article}] {pair['question']}"
-            output = pair["answer"]
-            data_list.append({"instruction": instruction, "output": output})
-    
-    print(f"Dataset size: {len(data_list)}")
-    
-    dataset = Dataset.from_list(data_list)
-    dataset = dataset.train_test_split(test_size=0.1)
+@dataclass
+class TrainingConfig:
+    train_model_name: str
+    finetuned_model_name: str
+    sequences_lenght: int = 1024
+    device: str = "cuda"
+    precision: str = "fp16"
+    quantization: Optional[str] = "8bit"
+    packing: bool = False
+    sys_prompt: str = DEFAULT_SYS_PROMPT
+    lora_r: int = 8
+    lora_alpha: int = 32
+    lora_dropout: float = 0.1
+    lora_target_modules: List[str] = field(default_factory=lambda: ["q_proj", "v_proj"])
+    num_train_epochs: int = 5
+    batch_size: int = 4
+    gradient_accumulation_steps: int = 1
+    learning_rate: float = 2e-4
+    gradient_checkpointing: bool = False
+    num_threads: Optional[int] = None
+    num_interop_threads: Optional[int] = None
+    pin_threads: bool = False
+    tokenization_num_proc: Optional[int] = None
+    use_tokenized_cache: bool = True
+    eval_steps: int = 100
+    save_steps: int = 200
+    logging_steps: int = 50
+    save_total_limit: int = 2
+    output_folder: str = "results"
+
+    def __post_init__(self):
+        if self.precision == "auto":
+            if self.device == "cuda":
+                self.precision = "fp16"
+            else:
+                self.precision = "bf16" if cpu_supports_bf16() else "fp32"
+        if self.device not in ("cpu", "cuda"):
+            raise ValueError(f"Unknown device: {self.device}")
+        if self.precision not in ("fp32", "fp16", "bf16"):
+            raise ValueError(f"Unknown precision: {self.precision}")
+        if self.quantization not in (None, "4bit", "8bit"):
+            raise ValueError(f"Unknown quantization: {self.quantization}")
+        if self.device == "cpu" and self.quantization is not None:
+            raise ValueError("bitsandbytes quantization requires device='cuda'")
+        if self.device == "cpu" and self.precision == "fp16":
+            raise ValueError("fp16 training is not supported on CPU, use 'bf16' or 'fp32'")
+        if self.device == "cpu" and self.packing:
+            raise ValueError("packing relies on flash_attention_2, use device='cuda' or packing=False")
+        if self.packing and importlib.util.find_spec("flash_attn") is None:
+            print("⚠️ flash_attn is not installed, falling back to length-grouped padding instead of packing")
+            self.packing = False
+
+def get_available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+def pin_threads(num_threads):
+    # One intra-op thread per core, kept on the same cores instead of migrating between them
+    os.environ.setdefault("OMP_PROC_BIND", "close")
+    os.environ.setdefault("OMP_PLACES", "cores")
 
-    tokenizer = AutoTokenizer.from_pretrained(train_model_name)
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, cpus[:num_threads] if num_threads else cpus)
 
-    def tokenize_function(sample):
-        prompt = f"Instruction: {sample['instruction']}\nAnswer: {sample['output']}\n"
-        tokenized = tokenizer(prompt, truncation=True, max_length=sequences_lenght, padding="max_length", return_tensors="pt")
-        return {
-            "input_ids": tokenized["input_ids"][0],
-            "attention_mask": tokenized["attention_mask"][0]
+def configure_threads(config: TrainingConfig):
+    if config.pin_threads:
+        pin_threads(config.num_threads)
+
+    if config.num_threads:
+        torch.set_num_threads(config.num_threads)
+
+    if config.num_interop_threads:
+        try:
+            torch.set_num_interop_threads(config.num_interop_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work started
+            print(f"⚠️ Inter-op threads already initialised ({torch.get_num_interop_threads()}), keeping them")
+
+def cpu_throughput_config(train_model_name, finetuned_model_name, **overrides):
+    params = {
+        "train_model_name": train_model_name,
+        "finetuned_model_name": finetuned_model_name,
+        "device": "cpu",
+        "precision": "auto",
+        "quantization": None,
+        "packing": False,
+        "batch_size": 16,
+        "gradient_accumulation_steps": 2,
+        "gradient_checkpointing": True,
+        "num_threads": get_available_cpus(),
+        "num_interop_threads": 1,
+        "pin_threads": True,
+    }
+    params.update(overrides)
+
+    return TrainingConfig(**params)
+
+class ThroughputCallback(TrainerCallback):
+    def __init__(self):
+        self.epochs_stats = []
+        self.epoch_start = None
+        self.epoch_start_step = 0
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        reset_peak_rss()
+        self.epoch_start = time.perf_counter()
+        self.epoch_start_step = state.global_step
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        elapsed = time.perf_counter() - self.epoch_start
+        samples = (state.global_step - self.epoch_start_step) * args.train_batch_size * args.gradient_accumulation_steps
+
+        stats = {
+            "epoch": state.epoch,
+            "seconds": elapsed,
+            "samples_per_second": samples / elapsed if elapsed > 0 else 0.0,
+            "peak_rss_mb": get_peak_rss_mb()
         }
+        self.epochs_stats.append(stats)
+        peak_rss = f"{stats['peak_rss_mb']:.0f} MB" if stats["peak_rss_mb"] is not None else "n/a"
+        print(f"Epoch {stats['epoch']:.2f}: {stats['samples_per_second']:.2f} samples/s, peak RSS {peak_rss}")
 
-    tokenized_datasets = dataset.map(tokenize_function, batched=False)
+def load_training_model(config: TrainingConfig):
+    model_kwargs = {"device_map": "auto" if config.device == "cuda" else "cpu"}
 
-    quant_config = BitsAndBytesConfig(
-        load_in_8bit=True,
-    )
-    model = AutoModelForCausalLM.from_pretrained(
-        train_model_name,
-        device_map="auto",
-        quantization_config=quant_config
-    )
+    if config.quantization == "8bit":
+        model_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+    elif config.quantization == "4bit":
+        model_kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.bfloat16 if config.precision == "bf16" else torch.float16,
+            bnb_4bit_quant_type="nf4",
+        )
+
+    if config.device == "cuda":
+        model_kwargs["attn_implementation"] = "flash_attention_2" if config.packing else "sdpa"
+
+    model = AutoModelForCausalLM.from_pretrained(config.train_model_name, **model_kwargs)
 
     lora_config = LoraConfig(
-        r=8,
-        lora_alpha=32,
-        target_modules=["q_proj", "v_proj"],
-        lora_dropout=0.1,
+        r=config.lora_r,
+        lora_alpha=config.lora_alpha,
+        target_modules=config.lora_target_modules,
+        lora_dropout=config.lora_dropout,
         bias="none",
         task_type="CAUSAL_LM",
     )
-    model = get_peft_model(model, lora_config)
 
-    training_args = TrainingArguments(
-        output_dir="./results",
-        num_train_epochs=5,
-        per_device_train_batch_size=1,
-        gradient_accumulation_steps=4,
+    return get_peft_model(model, lora_config)
+
+def build_training_arguments(config: TrainingConfig, output_dir):
+    return TrainingArguments(
+        output_dir=output_dir,
+        num_train_epochs=config.num_train_epochs,
+        per_device_train_batch_size=config.batch_size,
+        per_device_eval_batch_size=config.batch_size,
+        gradient_accumulation_steps=config.gradient_accumulation_steps,
+        gradient_checkpointing=config.gradient_checkpointing,
+        gradient_checkpointing_kwargs={"use_reentrant": False} if config.gradient_checkpointing else None,
+        group_by_length=not config.packing,
+        length_column_name="length",
         evaluation_strategy="steps",
-        eval_steps=100,
-        save_steps=200,
-        logging_steps=50,
-        learning_rate=2e-4,
-        fp16=True,
-        save_total_limit=2,
+        eval_steps=config.eval_steps,
+        save_steps=config.save_steps,
+        logging_steps=config.logging_steps,
+        learning_rate=config.learning_rate,
+        fp16=config.precision == "fp16",
+        bf16=config.precision == "bf16",
+        use_cpu=config.device == "cpu",
+        save_total_limit=config.save_total_limit,
         report_to="none",
     )
 
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+def get_run_key(config, dataset_key):
+    run_config = {key: value for key, value in asdict(config).items() if key not in RUN_KEY_IGNORED_FIELDS}
+    return hashlib.sha256(f"{json.dumps(run_config, sort_keys=True)}|{dataset_key}".encode("utf-8")).hexdigest()[:12]
+
+def train(qas_pairs, config: TrainingConfig):
+    configure_threads(config)
+
+    tokenizer = load_training_tokenizer(config.train_model_name)
+    tokenized_datasets = build_tokenized_datasets(qas_pairs, tokenizer, config.sequences_lenght, config.tokenization_num_proc, config.use_tokenized_cache, config.sys_prompt)
+
+    model = load_training_model(config)
+
+    # Checkpoints are only resumed by a run with the same training settings and the same tokenized data
+    dataset_key = get_tokenized_cache_key(build_data_list(qas_pairs, config.sys_prompt), tokenizer, config.sequences_lenght)
+    output_dir = f"{config.output_folder}/{config.finetuned_model_name}-{get_run_key(config, dataset_key)}"
+    last_checkpoint = get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+    if last_checkpoint is not None:
+        print(f"Resuming from {last_checkpoint}")
+
+    throughput_callback = ThroughputCallback()
     trainer = Trainer(
         model=model,
-        args=training_args,
+        args=build_training_arguments(config, output_dir),
         train_dataset=tokenized_datasets["train"],
         eval_dataset=tokenized_datasets["test"],
         tokenizer=tokenizer,
-        data_collator=data_collator
+        data_collator=build_data_collator(tokenizer, config.packing),
+        callbacks=[throughput_callback]
     )
 
-    trainer.train()
+    train_output = trainer.train(resume_from_checkpoint=last_checkpoint)
 
+    adapter_path = f"finetuned_models/{config.finetuned_model_name}"
     os.makedirs("finetuned_models", exist_ok=True)
-    model.save_pretrained(f"finetuned_models/{finetuned_model_name}")
\ No newline at end of file
+    model.save_pretrained(adapter_path)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    return {
+        "adapter_path": adapter_path,
+        "config": asdict(config),
+        "metrics": train_output.metrics,
+        "epochs_stats": throughput_callback.epochs_stats
+    }
+
+def finetune_model(qas_pairs, **params):
+    return train(qas_pairs, TrainingConfig(**params))
+
+def cpu_train(qas_pairs, train_model_name, sequences_lenght, finetuned_model_name, batch_size=4):
+    return train(qas_pairs, TrainingConfig(
+        train_model_name=train_model_name,
+        finetuned_model_name=finetuned_model_name,
+        sequences_lenght=sequences_lenght,
+        device="cpu",
+        precision="fp32",
+        quantization=None,
+        packing=False,
+        batch_size=batch_size
+    ))
+
+def gpu_train(qas_pairs, train_model_name, sequences_lenght, finetuned_model_name, batch_size=4, packing=False):
+    return train(qas_pairs, TrainingConfig(
+        train_model_name=train_model_name,
+        finetuned_model_name=finetuned_model_name,
+        sequences_lenght=sequences_lenght,
+        device="cuda",
+        precision="fp16",
+        quantization="8bit",
+        packing=packing,
+        batch_size=batch_size
+    ))
+
+def build_padded_batches(tokenized_samples, collator, batch_size, group_by_length):
+    samples = [{k: s[k] for k in ("input_ids", "attention_mask", "labels")} for s in tokenized_samples]
+    if group_by_length:
+        samples.sort(key=lambda s: len(s["input_ids"]))
+
+    batches = [collator(samples[i:i + batch_size]) for i in range(0, len(samples), batch_size)]
+    random.shuffle(batches)
+
+    return batches
+
+def measure_data_path_throughput(qas_pairs, train_model_name, sequences_lenght, batch_size=8, max_samples=64):
+    tokenizer = load_training_tokenizer(train_model_name)
+    data_list = build_data_list(qas_pairs)[:max_samples]
+    tokenized = tokenize_qa_pairs(
+        {key: [d[key] for d in data_list] for key in ("sys_prompt", "instruction", "output")},
+        tokenizer,
+        sequences_lenght
+    )
+    tokenized_samples = [dict(zip(tokenized.keys(), values)) for values in zip(*tokenized.values())]
+
+    model = AutoModelForCausalLM.from_pretrained(train_model_name, device_map="cpu")
+    model = get_peft_model(model, LoraConfig(r=8, lora_alpha=32, target_modules=["q_proj", "v_proj"], task_type="CAUSAL_LM"))
+    model.train()
+
+    max_length_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, padding="max_length", max_length=sequences_lenght, label_pad_token_id=IGNORE_INDEX)
+
+    data_paths = {
+        "max_length_padding": build_padded_batches(tokenized_samples, max_length_collator, 1, False),
+        "length_grouped_padding": build_padded_batches(tokenized_samples, build_data_collator(tokenizer), batch_size, True)
+    }
+
+    results = {}
+    for name, batches in data_paths.items():
+        real_tokens = 0
+        total_tokens = 0
+        supervised_tokens = 0
+
+        start = time.perf_counter()
+        for batch in batches:
+            outputs = model(**batch)
+            outputs.loss.backward()
+            model.zero_grad(set_to_none=True)
+
+            real_tokens += int(batch["attention_mask"].sum())
+            total_tokens += batch["input_ids"].numel()
+            supervised_tokens += int((batch["labels"] != IGNORE_INDEX).sum())
+        elapsed = time.perf_counter() - start
+
+        results[name] = {
+            "seconds": elapsed,
+            "tokens_per_second": real_tokens / elapsed,
+            "utilisation": real_tokens / total_tokens,
+            "supervised_ratio": supervised_tokens / total_tokens
+        }
+        print(f"{name}: {results[name]['tokens_per_second']:.1f} tokens/s, utilisation {results[name]['utilisation']:.1%}, supervised {results[name]['supervised_ratio']:.1%}")
+
+    return results
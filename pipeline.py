@@ -2,6 +2,46 @@ import json
 import os
 from typing import List, Callable
 
+def get_paper_key(paper):
+    return paper.get("arxiv_id") or paper["title"]
+
+def is_papers_list(data):
+    return isinstance(data, list) and len(data) > 0 and all(isinstance(p, dict) and "title" in p for p in data)
+
+def is_same_paper(paper, other):
+    # Results cached before arxiv ids were tracked only carry the title
+    if paper.get("arxiv_id") and other.get("arxiv_id"):
+        return paper["arxiv_id"] == other["arxiv_id"]
+
+    return paper["title"] == other["title"]
+
+def is_paper_in_results(paper, results):
+    if isinstance(results, dict):
+        return paper["title"] in results
+
+    if isinstance(results, list):
+        return any(isinstance(r, dict) and "title" in r and is_same_paper(r, paper) for r in results)
+
+    return True
+
+def select_papers_results(results, papers):
+    if isinstance(results, dict):
+        return {p["title"]: results[p["title"]] for p in papers if p["title"] in results}
+
+    return [r for r in results if isinstance(r, dict) and "title" in r and any(is_same_paper(r, p) for p in papers)]
+
+def merge_step_results(existing_results, new_results, changed_papers, stale_titles):
+    if isinstance(existing_results, list) and isinstance(new_results, list):
+        kept = [r for r in existing_results if not (isinstance(r, dict) and "title" in r and any(is_same_paper(r, p) for p in changed_papers))]
+        return kept + new_results
+
+    if isinstance(existing_results, dict) and isinstance(new_results, dict):
+        merged = {title: value for title, value in existing_results.items() if title not in stale_titles}
+        merged.update(new_results)
+        return merged
+
+    return new_results
+
 class Task():
     def __init__(self, func, params, refresh=False):
         self.func: Callable[[any], any] = func
@@ -9,18 +49,27 @@ class Task():
         self.params: dict = params
         self.refresh: bool = refresh
 
-    def run(self, index, pipeline_params, step_before_results, step_before_executed, directory):
+    def get_file_name(self, index, directory):
+        return f"{directory}/{index}_{self.func_name}.json"
+
+    def is_cached(self, index, pipeline_params, directory):
         task_name = f"{index}_{self.func_name}"
-        file_name = f"{directory}/{task_name}.json"
+        return os.path.exists(self.get_file_name(index, directory)) and task_name in pipeline_params and pipeline_params[task_name] == self.params
+
+    def save(self, index, directory, results):
+        with open(self.get_file_name(index, directory), "w") as f:
+            json.dump(results, f)
 
-        if not step_before_executed and not self.refresh and os.path.exists(file_name) and task_name in pipeline_params and pipeline_params[task_name] == self.params:
+    def run(self, index, pipeline_params, step_before_results, step_before_executed, directory):
+        file_name = self.get_file_name(index, directory)
+
+        if not step_before_executed and not self.refresh and self.is_cached(index, pipeline_params, directory):
             with open(file_name, "r") as f:
                 return False, json.load(f)
 
         results = self.func(step_before_results, **self.params)
-        with open(file_name, "w") as f:
-            json.dump(results, f)
-        
+        self.save(index, directory, results)
+
         return True, results
 
 class Pipeline():
@@ -29,48 +78,128 @@ class Pipeline():
     def __init__(self, pipeline_name, tasks=[], initial_data=None):
         self.pipeline_folder = f"{Pipeline.MAIN_FOLDER}/{pipeline_name}"
         self.pipeline_execution_file = f"{self.pipeline_folder}/execution.json"
+        self.papers_state_file = f"{self.pipeline_folder}/papers_state.json"
         self.tasks: List[Task] = tasks
         self.initial_data = initial_data
-        
+
         if not os.path.exists(Pipeline.MAIN_FOLDER):
             os.mkdir(Pipeline.MAIN_FOLDER)
-        
+
         if not os.path.exists(self.pipeline_folder):
             os.mkdir(self.pipeline_folder)
-    
-    def run(self, clean_cache=False):
+
+    def run(self, clean_cache=False, incremental=False):
         if os.path.exists(self.pipeline_execution_file):
             with open(self.pipeline_execution_file, "r") as f:
                 pipeline_params = json.load(f)
         else:
             pipeline_params = {}
-        
+
         if clean_cache:
             self.clean_cache()
-        
+        elif incremental:
+            if os.path.exists(self.papers_state_file) and all(task.is_cached(i, pipeline_params, self.pipeline_folder) for i, task in enumerate(self.tasks[1:], start=1)):
+                return self.run_incremental(pipeline_params)
+            print("=> No complete previous run with the same parameters, running the full pipeline")
+
         results = self.initial_data
+        papers = None
+        processed_results = None
         executed = False
         for i, task in enumerate(self.tasks):
             print(f"[{i + 1}/{len(self.tasks)}] - {task.func_name}")
 
             executed, results = task.run(i, pipeline_params, results, executed, self.pipeline_folder)
 
-            if executed:
-                pipeline_params[f"{i}_{task.func_name}"] = task.params
-                
-                with open(self.pipeline_execution_file, "w") as f:
-                    json.dump(pipeline_params, f, indent=2)
+            if i == 0 and is_papers_list(results):
+                papers = processed_results = results
+            elif i == 1:
+                processed_results = results
 
+            if executed:
+                self.save_execution(pipeline_params, i, task)
                 print("=> Executed")
             else:
                 print("=> Skiped")
-    
+
+        if papers is not None:
+            self.save_papers_state(papers, processed_results, results)
+
+    def run_incremental(self, pipeline_params):
+        source_task = self.tasks[0]
+        print(f"[1/{len(self.tasks)}] - {source_task.func_name}")
+
+        papers = source_task.func(self.initial_data, **source_task.params)
+        source_task.save(0, self.pipeline_folder, papers)
+        self.save_execution(pipeline_params, 0, source_task)
+        print("=> Executed")
+
+        papers_state = self.load_papers_state()
+        changed_papers = [p for p in papers if papers_state.get(get_paper_key(p), {}).get("version") != p.get("version")]
+        stale_titles = {papers_state[get_paper_key(p)]["title"] for p in changed_papers if get_paper_key(p) in papers_state}
+        incomplete_papers = [p for p in papers if p not in changed_papers and not papers_state.get(get_paper_key(p), {}).get("complete", True)]
+        print(f"=> {len(changed_papers)} new or updated papers out of {len(papers)}, {len(incomplete_papers)} to resume")
+
+        results = changed_papers
+        merged_results = processed_results = papers
+        for i, task in enumerate(self.tasks[1:], start=1):
+            print(f"[{i + 1}/{len(self.tasks)}] - {task.func_name}")
+
+            with open(task.get_file_name(i, self.pipeline_folder), "r") as f:
+                existing_results = json.load(f)
+
+            # Papers that failed or were cut at this step on a previous run resume from the step before's stored output
+            resumed_papers = [p for p in incomplete_papers if is_paper_in_results(p, merged_results) and not is_paper_in_results(p, existing_results)]
+            if resumed_papers:
+                results = merge_step_results(results, select_papers_results(merged_results, resumed_papers), [], set())
+
+            # Only the delta flows to the next step, the stored step output is the merge of both
+            if results:
+                results = task.func(results, **task.params)
+                print(f"=> Executed on {len(results)} new items")
+            else:
+                results = type(existing_results)()
+                print("=> Skiped")
+
+            merged_results = merge_step_results(existing_results, results, changed_papers, stale_titles)
+            task.save(i, self.pipeline_folder, merged_results)
+            if i == 1:
+                processed_results = merged_results
+
+        self.save_papers_state(papers, processed_results, merged_results)
+
+    def save_execution(self, pipeline_params, index, task):
+        pipeline_params[f"{index}_{task.func_name}"] = task.params
+
+        with open(self.pipeline_execution_file, "w") as f:
+            json.dump(pipeline_params, f, indent=2)
+
+    def load_papers_state(self):
+        if not os.path.exists(self.papers_state_file):
+            return {}
+
+        with open(self.papers_state_file, "r") as f:
+            return json.load(f)
+
+    def save_papers_state(self, papers, processed_results, final_results):
+        # Papers that failed cleaning are fetched and cleaned again on the next run, papers that failed
+        # or were cut by an amount limit in a later step are marked incomplete and resume from that step
+        papers_state = self.load_papers_state()
+        for p in papers:
+            if is_paper_in_results(p, processed_results):
+                papers_state[get_paper_key(p)] = {"version": p.get("version"), "title": p["title"], "complete": is_paper_in_results(p, final_results)}
+            else:
+                papers_state.pop(get_paper_key(p), None)
+
+        with open(self.papers_state_file, "w") as f:
+            json.dump(papers_state, f, indent=2)
+
     def get_data_from_step(self, id):
         for file in os.listdir(self.pipeline_folder):
             if ".json" in file and file.startswith(f"{id}_"):
                 with open(f"{self.pipeline_folder}/{file}", "r") as f:
                     return json.load(f)
-    
+
     def clean_cache(self):
         for file in [f"{self.pipeline_folder}/{file}" for file in os.listdir(self.pipeline_folder) if ".json" in file and file != "execution.json"]:
-            os.remove(file)
\ No newline at end of file
+            os.remove(file)
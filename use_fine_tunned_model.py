@@ -1,52 +1,275 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, TextIteratorStreamer
 from peft import PeftModel
+from collections import OrderedDict
+import importlib.util
+import os
 import torch
+from threading import Thread
+from utils import cpu_supports_bf16, build_chat_prompt, DEFAULT_SYS_PROMPT
+
+MAX_LOADED_ADAPTERS = 4
+DEFAULT_MAX_NEW_TOKENS = 512
+STREAM_TIMEOUT_SECONDS = 300
+
+def is_pre_quantized(model_name):
+    return getattr(AutoConfig.from_pretrained(model_name), "quantization_config", None) is not None
+
+def load_base_model(model_name, device="auto"):
+    use_cuda = device != "cpu" and torch.cuda.is_available()
+
+    if use_cuda:
+        quant_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4",
+        )
+
+        base_model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            device_map="auto",
+            attn_implementation="flash_attention_2" if importlib.util.find_spec("flash_attn") else "sdpa",
+            quantization_config=quant_config
+        )
+    else:
+        # Pre-quantized checkpoints (e.g. the unsloth bnb-4bit ones) still need bitsandbytes and CUDA,
+        # the adapters load on the full precision release of the same model (e.g. meta-llama/Llama-3.2-3B-Instruct)
+        if is_pre_quantized(model_name):
+            raise ValueError(f"{model_name} is a pre-quantized checkpoint that needs CUDA, pass its full precision release to run on CPU")
+
+        base_model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            device_map="cpu",
+            attn_implementation="sdpa",
+            torch_dtype=torch.bfloat16 if cpu_supports_bf16() else torch.float32
+        )
 
-def load_optimized_model(model_name, adaptator_name, compile_model=True):
-    quant_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_quant_type="nf4",
-    )
-    
-    base_model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        device_map="auto",
-        attn_implementation="flash_attention_2",
-        quantization_config=quant_config
-    )
-
-    model = PeftModel.from_pretrained(base_model, f"finetuned_models/{adaptator_name}")
-    if compile_model:
-        model = torch.compile(model)
-    
     tokenizer = AutoTokenizer.from_pretrained(model_name)
-    tokenizer.pad_token = tokenizer.eos_token  
-    
-    return model, tokenizer
+    tokenizer.pad_token = tokenizer.eos_token
+
+    return base_model, tokenizer
+
+def validate_max_loaded_adapters(max_loaded_adapters):
+    # The adapter being activated always stays loaded
+    if max_loaded_adapters < 1:
+        raise ValueError(f"max_loaded_adapters must be at least 1, got {max_loaded_adapters}")
+
+    return max_loaded_adapters
+
+class ModelRegistry():
+    def __init__(self, model_name, device="auto", max_loaded_adapters=MAX_LOADED_ADAPTERS):
+        self.model_name: str = model_name
+        self.device: str = device
+        self.max_loaded_adapters: int = validate_max_loaded_adapters(max_loaded_adapters)
+        self.base_model, self.tokenizer = load_base_model(model_name, device)
+        self.model: PeftModel = None
+        self.compiled_model = None
+        self.loaded_adapters: OrderedDict = OrderedDict()
+
+    def load_adapter(self, adaptator_name):
+        if adaptator_name in self.loaded_adapters:
+            self.loaded_adapters.move_to_end(adaptator_name)
+            return
+
+        adapter_path = f"finetuned_models/{adaptator_name}"
+        if self.model is None:
+            self.model = PeftModel.from_pretrained(self.base_model, adapter_path, adapter_name=adaptator_name)
+            self.model.eval()
+        else:
+            self.model.load_adapter(adapter_path, adapter_name=adaptator_name)
+
+        self.loaded_adapters[adaptator_name] = adapter_path
+        self.evict_adapters(keep=adaptator_name)
+
+    def evict_adapters(self, keep):
+        while len(self.loaded_adapters) > self.max_loaded_adapters:
+            oldest = next(name for name in self.loaded_adapters if name != keep)
+            if self.model.active_adapter == oldest:
+                self.model.set_adapter(keep)
+            self.model.delete_adapter(oldest)
+            del self.loaded_adapters[oldest]
+
+    def set_max_loaded_adapters(self, max_loaded_adapters):
+        self.max_loaded_adapters = validate_max_loaded_adapters(max_loaded_adapters)
+        if self.loaded_adapters:
+            self.evict_adapters(keep=next(reversed(self.loaded_adapters)))
+
+    def set_adapter(self, adaptator_name):
+        self.load_adapter(adaptator_name)
+        self.model.set_adapter(adaptator_name)
+
+    def get_model(self, adaptator_name, compile_model=False):
+        self.set_adapter(adaptator_name)
+
+        if not compile_model:
+            return self.model, self.tokenizer
+
+        # Compiled once, switching adapters only invalidates the guards instead of reloading everything
+        if self.compiled_model is None:
+            self.compiled_model = torch.compile(self.model)
+
+        return self.compiled_model, self.tokenizer
+
+    def export_merged(self, adaptator_name, full_precision_model_name, output_folder="merged_models"):
+        output_path = f"{output_folder}/{adaptator_name}"
+
+        # Merging into 4-bit weights is lossy, so the adapter has to be folded into the full precision
+        # release of the base model (e.g. meta-llama/Llama-3.2-3B-Instruct for the unsloth bnb-4bit one)
+        if is_pre_quantized(full_precision_model_name):
+            raise ValueError(f"{full_precision_model_name} is a pre-quantized checkpoint, pass its full precision release")
+
+        base_model = AutoModelForCausalLM.from_pretrained(full_precision_model_name, device_map="cpu", torch_dtype=torch.float16)
+        merged_model = PeftModel.from_pretrained(base_model, f"finetuned_models/{adaptator_name}").merge_and_unload()
+
+        os.makedirs(output_folder, exist_ok=True)
+        merged_model.save_pretrained(output_path)
+        self.tokenizer.save_pretrained(output_path)
+
+        return output_path
+
+_registries = {}
 
-def question_model(model, tokenizer, user_input, sys_prompt=""):
-    chat_prompt = f"<|system|>\n{sys_prompt}\n<|user|>\n{user_input}\n<|assistant|>\n"
+def get_model_registry(model_name, device="auto", max_loaded_adapters=None):
+    key = (model_name, device)
+    if key not in _registries:
+        _registries[key] = ModelRegistry(model_name, device, MAX_LOADED_ADAPTERS if max_loaded_adapters is None else max_loaded_adapters)
+    elif max_loaded_adapters is not None and _registries[key].max_loaded_adapters != max_loaded_adapters:
+        _registries[key].set_max_loaded_adapters(max_loaded_adapters)
 
-    inputs = tokenizer(
-        chat_prompt,
+    return _registries[key]
+
+def load_optimized_model(model_name, adaptator_name, compile_model=True, device="auto"):
+    # Every adapter of a base model shares the same PeftModel, the returned model answers with whichever adapter
+    # was activated last. To compare adapters, call load_optimized_model (or get_model_registry(...).set_adapter)
+    # again right before questioning each one instead of keeping several handles around
+    registry = get_model_registry(model_name, device)
+    return registry.get_model(adaptator_name, compile_model)
+
+def load_merged_model(merged_model_path, device="auto", compile_model=True):
+    base_model, tokenizer = load_base_model(merged_model_path, device)
+    base_model.eval()
+    if compile_model:
+        base_model = torch.compile(base_model)
+
+    return base_model, tokenizer
+
+def build_generation_kwargs(tokenizer, max_new_tokens, stop_strings, generate_kwargs):
+    kwargs = {
+        "do_sample": True,
+        "max_new_tokens": max_new_tokens,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    if stop_strings:
+        kwargs["stop_strings"] = stop_strings
+        kwargs["tokenizer"] = tokenizer
+    kwargs.update(generate_kwargs)
+
+    return kwargs
+
+def truncate_at_stop_strings(text, stop_strings):
+    for stop_string in stop_strings or []:
+        index = text.find(stop_string)
+        if index != -1:
+            text = text[:index]
+
+    return text.strip()
+
+def tokenize_chat_prompts(tokenizer, chat_prompts, device):
+    # The chat template already contains <|begin_of_text|>
+    return tokenizer(
+        chat_prompts,
         return_tensors="pt",
-        truncation=True,
-        padding=True
-    )
-    
-    input_ids = inputs.input_ids.to(model.device)
-    attention_mask = inputs.attention_mask.to(model.device)
-    
+        padding=True,
+        add_special_tokens=False
+    ).to(device)
+
+def question_model(model, tokenizer, user_input, sys_prompt=DEFAULT_SYS_PROMPT, max_new_tokens=DEFAULT_MAX_NEW_TOKENS, stop_strings=None, **generate_kwargs):
+    return question_model_batch(
+        model,
+        tokenizer,
+        [user_input],
+        sys_prompt,
+        max_new_tokens=max_new_tokens,
+        stop_strings=stop_strings,
+        **generate_kwargs
+    )[0][0]
+
+def question_model_batch(model, tokenizer, user_inputs, sys_prompt=DEFAULT_SYS_PROMPT, num_return_sequences=1, max_batch_size=16, max_new_tokens=DEFAULT_MAX_NEW_TOKENS, stop_strings=None, **generate_kwargs):
+    chat_prompts = [build_chat_prompt(tokenizer, user_input, sys_prompt) for user_input in user_inputs]
+    generation_kwargs = build_generation_kwargs(tokenizer, max_new_tokens, stop_strings, generate_kwargs)
+
+    # Sorting by length keeps prompts of similar size together and minimises left padding
+    prompts_lengths = [len(ids) for ids in tokenizer(chat_prompts, add_special_tokens=False)["input_ids"]]
+    order = sorted(range(len(chat_prompts)), key=lambda i: prompts_lengths[i])
+    prompts_per_batch = max(1, max_batch_size // num_return_sequences)
+
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
     torch.backends.cuda.matmul.allow_tf32 = True
-    
-    output_ids = model.generate(
-        input_ids,
-        attention_mask=attention_mask,
-        do_sample=True,
-        pad_token_id=tokenizer.eos_token_id
-    )
-
-    output_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
-    
-    return output_text[len(chat_prompt):].strip()
+
+    outputs = [None] * len(chat_prompts)
+    try:
+        for start in range(0, len(order), prompts_per_batch):
+            batch_indexes = order[start:start + prompts_per_batch]
+            inputs = tokenize_chat_prompts(tokenizer, [chat_prompts[i] for i in batch_indexes], model.device)
+
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    **inputs,
+                    num_return_sequences=num_return_sequences,
+                    **generation_kwargs
+                )
+
+            output_texts = tokenizer.batch_decode(output_ids[:, inputs.input_ids.shape[1]:], skip_special_tokens=True)
+            for j, i in enumerate(batch_indexes):
+                sequences = output_texts[j * num_return_sequences:(j + 1) * num_return_sequences]
+                outputs[i] = [truncate_at_stop_strings(text, stop_strings) for text in sequences]
+    finally:
+        tokenizer.padding_side = padding_side
+
+    return outputs
+
+def stream_model(model, tokenizer, user_input, sys_prompt=DEFAULT_SYS_PROMPT, max_new_tokens=DEFAULT_MAX_NEW_TOKENS, stop_strings=None, timeout=STREAM_TIMEOUT_SECONDS, **generate_kwargs):
+    chat_prompt = build_chat_prompt(tokenizer, user_input, sys_prompt)
+    inputs = tokenize_chat_prompts(tokenizer, [chat_prompt], model.device)
+
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+    generation_kwargs = build_generation_kwargs(tokenizer, max_new_tokens, stop_strings, generate_kwargs)
+    errors = []
+
+    def generate():
+        try:
+            with torch.inference_mode():
+                model.generate(**inputs, streamer=streamer, **generation_kwargs)
+        except Exception as e:
+            # Unblocks the consumer, the error is raised again on its side
+            errors.append(e)
+            streamer.end()
+
+    thread = Thread(target=generate, daemon=True)
+    thread.start()
+
+    # A stop string can span several chunks, so its possible beginning is held back until it is resolved
+    holdback = max((len(stop_string) for stop_string in stop_strings or []), default=1) - 1
+    text = ""
+    emitted = 0
+    stopped = False
+    for new_text in streamer:
+        text += new_text
+
+        stop_indexes = [text.find(stop_string) for stop_string in stop_strings or [] if stop_string in text]
+        if stop_indexes:
+            if min(stop_indexes) > emitted:
+                yield text[emitted:min(stop_indexes)]
+            stopped = True
+            break
+
+        if len(text) - holdback > emitted:
+            yield text[emitted:len(text) - holdback]
+            emitted = len(text) - holdback
+
+    if not stopped and len(text) > emitted:
+        yield text[emitted:]
+
+    thread.join()
+    if errors:
+        raise errors[0]
@@ -1,3 +1,15 @@
+import os
+import platform
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then reported as None
+    resource = None
+
+# Used both to build the fine-tuning samples and to question the fine-tuned model, so both see the same prompt
+DEFAULT_SYS_PROMPT = "Answer concisely."
+
 def wrap_text(text, max_length=80, separator="\n"):
     words = text.split()
     lines = []
@@ -14,3 +26,42 @@ def wrap_text(text, max_length=80, separator="\n"):
         lines.append(current_line.strip())
     
     return separator.join(lines)
+
+def build_chat_prompt(tokenizer, user_input, sys_prompt=""):
+    messages = []
+    if sys_prompt:
+        messages.append({"role": "system", "content": sys_prompt})
+    messages.append({"role": "user", "content": user_input})
+
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+def cpu_supports_bf16():
+    # Imported here so the data pipeline and the benchmark can use utils without torch installed
+    import torch
+
+    is_avx512_bf16_supported = getattr(torch.cpu, "_is_avx512_bf16_supported", lambda: False)
+    is_amx_tile_supported = getattr(torch.cpu, "_is_amx_tile_supported", lambda: False)
+
+    return is_avx512_bf16_supported() or is_amx_tile_supported()
+
+def reset_peak_rss():
+    # Linux only, lets every measure report its own peak instead of the whole process one
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def get_peak_rss_mb():
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if platform.system() == "Darwin" else peak_rss / 1024